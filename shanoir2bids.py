@@ -298,6 +298,7 @@ class DownloadShanoirDatasetToBIDS:
         self.list_fars = []  # List of substrings to edit in subjects names
         self.dl_dir = None  # download directory, where data will be stored
         self.parser = None  # Shanoir Downloader Parser
+        self.shanoir_config = None  # Last shanoir_downloader configuration, its session and keycloak tokens are reused
         self.n_seq = 0  # Number of sequences in the shanoir2bids_dict
         self.log_fn = None
         self.dcm2niix_path = None  # Path to the dcm2niix the user wants to use
@@ -637,10 +638,16 @@ class DownloadShanoirDatasetToBIDS:
                     "id,ASC",
                     "-t",
                     "500",
+                    "-bs",
+                    "1",
                 ]
-            )  # Increase time out for heavy files
+            )  # Increase time out for heavy files, one archive per dataset
 
             config = shanoir_downloader.initialize(args)
+            if self.shanoir_config is not None:
+                # Reuse the connections and keycloak tokens so that the password is only asked once
+                shanoir_downloader.share_session(config, self.shanoir_config)
+            self.shanoir_config = config
             response = shanoir_downloader.solr_search(config, args)
 
             # From response, process the data
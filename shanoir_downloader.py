@@ -1,16 +1,48 @@
 import datetime
+import hashlib
+import time
 import os
+import shutil
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
 import json
 import getpass
 import re
+import urllib.parse
 import sys
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
+import functools
 import http.client as http_client
 from http.client import responses
 from pathlib import Path
-Path.ls = lambda x: sorted(list(x.iterdir()))
+
+# the format parameter expected by the download endpoints for each --format choice
+FILE_FORMATS = { 'nifti': 'nii', 'dicom': 'dcm' }
+
+# maximum number of datasets in a single massiveDownload request
+MAX_DATASETS_PER_DOWNLOAD = 50
+
+# timestamp of the default log file name, computed once per process
+LOG_TIMESTAMP = datetime.datetime.now().strftime("%Y-%m-%d_%Hh%Mm%S")
+
+# argparse type for the arguments which must be strictly positive integers
+def positive_int(value):
+	value = int(value)
+	if value < 1:
+		raise argparse.ArgumentTypeError(f'{value} is not a positive integer')
+	return value
+
+# argparse type of --batch_size, the server accepts at most MAX_DATASETS_PER_DOWNLOAD datasets per archive
+def dataset_batch_size(value):
+	value = positive_int(value)
+	if value > MAX_DATASETS_PER_DOWNLOAD:
+		raise argparse.ArgumentTypeError(f'{value} is greater than the maximum batch size {MAX_DATASETS_PER_DOWNLOAD}')
+	return value
 
 def create_arg_parser(description="""Shanoir downloader"""):
 	parser = argparse.ArgumentParser(prog=__file__, description=description, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -28,7 +60,7 @@ def add_domain_argument(parser):
 def add_common_arguments(parser):
 	add_username_argument(parser)
 	add_domain_argument(parser)
-	parser.add_argument('-f', '--format', default='nifti', choices=['nifti', 'dicom'], help='The format to download.')
+	parser.add_argument('-f', '--format', default='nifti', choices=list(FILE_FORMATS), help='The format to download.')
 	add_output_folder_argument(parser)
 
 def add_search_arguments(parser):
@@ -37,6 +69,7 @@ def add_search_arguments(parser):
 	parser.add_argument('-so', '--sort', help='How to sort the result page.', default='id,DESC')
 	parser.add_argument('-em', '--expert_mode', action='store_true', help='Export mode.')
 	parser.add_argument('-st', '--search_text', help='The search text. See the info box on https://shanoir.irisa.fr/shanoir-ng/solr-search.')
+	parser.add_argument('-bs', '--batch_size', type=dataset_batch_size, default=MAX_DATASETS_PER_DOWNLOAD, help=f'Number of search results downloaded in a single archive (at most {MAX_DATASETS_PER_DOWNLOAD}). Use 1 to download each dataset in its own archive.')
 
 def add_configuration_arguments(parser):
 	parser.add_argument('-c', '--configuration_folder', required=False, help='Path to the configuration folder containing proxy.properties (Tries to use ~/.su_vX.X.X/ by default). You can also use --proxy_url to configure the proxy (in which case the proxy.properties file will be ignored).')
@@ -44,6 +77,7 @@ def add_configuration_arguments(parser):
 	parser.add_argument('-ca', '--certificate', default='', required=False, help='Path to the CA bundle to use.')
 	parser.add_argument('-v', '--verbose', default=False, action='store_true', help='Print log messages.')
 	parser.add_argument('-t', '--timeout', type=float, default=60*4, help='The request timeout.')
+	parser.add_argument('-cc', '--concurrency', type=positive_int, default=8, help='Number of datasets downloaded in parallel when downloading search results.')
 	parser.add_argument('-lf', '--log_file', type=str, help="Path to the log file. Default is output_folder/downloads.log", default=None)
 	return parser
 
@@ -58,7 +92,7 @@ def init_logging(args):
 
 	verbose = args.verbose
 	
-	logfile = Path(args.log_file) if args.log_file else Path(args.output_folder) / f'downloads{datetime.datetime.now().strftime("%Y-%m-%d_%Hh%Mm%S")}.log'
+	logfile = Path(args.log_file) if args.log_file else Path(args.output_folder) / f'downloads{LOG_TIMESTAMP}.log'
 	logfile.parent.mkdir(exist_ok=True, parents=True)
 
 	logging.basicConfig(
@@ -79,6 +113,31 @@ def init_logging(args):
 		requests_log.propagate = True
 
 
+# create the session shared by all requests, so that connections (and TLS handshakes) to the server are reused
+# the pool keeps at least one connection per concurrent download (see --concurrency), otherwise the connections of the extra threads are discarded after each request
+def create_session(verify, proxies, concurrency=1):
+	session = requests.Session()
+	retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504], raise_on_status=False)
+	session.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=max(20, concurrency), max_retries=retries))
+	session.verify = verify
+	if proxies:
+		session.proxies.update(proxies)
+	session.headers.update({ 'content-type': 'application/json' })
+	return session
+
+# the latest shanoir uploader configuration folder (~/.su_vX.X.X/), or the home folder if there is none
+@functools.lru_cache(maxsize=1)
+def get_default_configuration_folder():
+	cfs = sorted(Path.home().glob('.su_v*'))
+	return cfs[-1] if len(cfs) > 0 else Path.home()
+
+# reuse the session and the keycloak tokens of a previous configuration (created with the same connection arguments), so that the password is only asked once
+def share_session(config, previous_config):
+	config['session'].close()
+	for key in ['session', 'access_token', 'refresh_token', 'access_token_expiry', 'token_lock']:
+		config[key] = previous_config[key]
+	return config
+
 def initialize(args, verbose=True):
 
 	server_domain = args.domain
@@ -107,27 +166,18 @@ def initialize(args, verbose=True):
 		if hasattr(args, 'configuration_folder') and args.configuration_folder:
 			configuration_folder = Path(args.configuration_folder)
 		else:
-			cfs = sorted(list(Path.home().glob('.su_v*')))
-			configuration_folder = cfs[-1] if len(cfs) > 0 else Path().home()
+			configuration_folder = get_default_configuration_folder()
 
 		proxy_settings = configuration_folder / 'proxy.properties'
 		
-		proxy_config = {}
-
 		if proxy_settings.exists():
-			with open(proxy_settings) as file:
-				for line in file:
-					if line.startswith('proxy.'):
-						line_s = line.split('=')
-						proxy_key = line_s[0]
-						proxy_value = line_s[1].strip()
-						proxy_key = proxy_key.split('.')[-1]
-						proxy_config[proxy_key] = proxy_value
-			
-				if 'enabled' not in proxy_config or proxy_config['enabled'] == 'true':
-					if 'user' in proxy_config and len(proxy_config['user']) > 0 and 'password' in proxy_config and len(proxy_config['password']) > 0:
-						proxy_url = proxy_config['user'] + ':' + proxy_config['password']
-					proxy_url += '@' + proxy_config['host'] + ':' + proxy_config['port']
+			# proxy.properties contains lines like "proxy.host=...", only the last part of the key is kept
+			proxy_config = dict(re.findall(r'^proxy\.(?:\w+\.)*(\w+)[ \t]*=[ \t]*(.*?)\s*$', proxy_settings.read_text(), re.M))
+
+			if proxy_config.get('enabled', 'true') == 'true' and 'host' in proxy_config:
+				proxy_url = f"{proxy_config['host']}:{proxy_config['port']}"
+				if proxy_config.get('user') and proxy_config.get('password'):
+					proxy_url = f"{proxy_config['user']}:{proxy_config['password']}@{proxy_url}"
 		else:
 			if verbose:
 				print("Proxy configuration file not found. Proxy will be ignored.")
@@ -141,11 +191,24 @@ def initialize(args, verbose=True):
 			# 'https': 'https://' + proxy_url,
 		}
 	
-	return { 'domain': server_domain, 'username': username, 'verify': verify, 'proxies': proxies, 'output_folder': output_folder, 'timeout': args.timeout }
+	concurrency = args.concurrency if hasattr(args, 'concurrency') else 1
+	session = create_session(verify, proxies, concurrency)
+
+	return { 'domain': server_domain, 'username': username, 'verify': verify, 'proxies': proxies, 'output_folder': output_folder, 'timeout': args.timeout, 'session': session, 'access_token': None, 'refresh_token': None, 'access_token_expiry': 0, 'token_lock': threading.Lock() }
 
 
-access_token = None
-refresh_token = None
+# the access token is refreshed this many seconds before its expiry, so that it does not expire during a request
+TOKEN_EXPIRY_MARGIN = 30
+
+# store the tokens of a keycloak token response in the config, along with the (monotonic) time at which the access token must be refreshed
+# the Authorization header of the session is updated once here instead of being rebuilt for each request
+def store_tokens(config, response_json):
+	config['session'].headers['Authorization'] = 'Bearer ' + response_json['access_token']
+	config['access_token'] = response_json['access_token']
+	config['refresh_token'] = response_json.get('refresh_token', config['refresh_token'])
+	expires_in = response_json.get('expires_in')
+	config['access_token_expiry'] = time.monotonic() + expires_in - TOKEN_EXPIRY_MARGIN if expires_in else float('inf')
+	return config['access_token']
 
 # using user's password, get the first access token and the refresh token
 def ask_access_token(config):
@@ -165,52 +228,59 @@ def ask_access_token(config):
 
 	headers = {'content-type': 'application/x-www-form-urlencoded'}
 	print('get keycloak token...', end=' ')
-	response = requests.post(url, data=payload, headers=headers, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'])
+	response = config['session'].post(url, data=payload, headers=headers, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'])
 	if not hasattr(response, 'status_code') or response.status_code != 200:
 		print('Failed to connect, make sur you have a certified IP or are connected on a valid VPN.')
 		sys.exit(1)
 	
-	response_json = json.loads(response.text)
+	response_json = response.json()
 	if 'error_description' in response_json and response_json['error_description'] == 'Invalid user credentials':
 		print('bad username or password')
 		sys.exit(1)
-	global refresh_token 
-	refresh_token = response_json['refresh_token']
-	return response_json['access_token']
+	return store_tokens(config, response_json)
+
+# matches the file name in a Content-Disposition header: filename="name", filename=name or filename*=UTF-8''name
+CONTENT_DISPOSITION_FILENAME_RE = re.compile(r'filename\*?=(?:UTF-8\'\')?"?([^";]+)"?', re.I)
 
 def get_filename_from_response(output_folder, response):
 	filename = None
 	if response.headers and 'Content-Disposition' in response.headers:
-		filenames = re.findall('filename=(.+)', response.headers['Content-Disposition'])
-		filename = str(output_folder / filenames[0]) if len(filenames) > 0 else None
+		match = CONTENT_DISPOSITION_FILENAME_RE.search(response.headers['Content-Disposition'])
+		filename = str(output_folder / Path(urllib.parse.unquote(match.group(1).strip())).name) if match else None
 	if filename is None:
-		raise Exception('Could not find file name in response header', response.status_code, response.reason, response.error, response.headers, response)
+		raise Exception('Could not find file name in response header', response.status_code, response.reason, response.headers, response)
 	return filename
 
+# size of the chunks read from the response stream and written to disk
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# number of times an interrupted download is resumed before giving up, and backoff factor between attempts
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_BACKOFF_FACTOR = 1
+
 try:
 	from tqdm import tqdm
 
-	def download_file(output_folder, response):
-		filename = get_filename_from_response(output_folder, response)
-		if not filename: return
-		total = int(response.headers.get('content-length', 0))
-		with open(filename, 'wb') as file, tqdm(
+	def write_response(response, filename, mode='wb', offset=0):
+		total = offset + int(response.headers.get('content-length', 0))
+		with open(filename, mode, buffering=DOWNLOAD_CHUNK_SIZE) as file, tqdm(
 			desc=filename,
 			total=total,
+			initial=offset,
 			unit='iB',
 			unit_scale=True,
 			unit_divisor=1024,
 		) as bar:
-			for data in response.iter_content(chunk_size=1024):
-				size = file.write(data)
-				bar.update(size)
+			for data in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+				file.write(data)
+				bar.update(len(data))
 
 except ImportError as e:
 
-	def download_file(output_folder, response):
-		filename = get_filename_from_response(output_folder, response)
-		if not filename: return
-		open(filename, 'wb').write(response.content)
+	def write_response(response, filename, mode='wb', offset=0):
+		response.raw.decode_content = True
+		with open(filename, mode, buffering=DOWNLOAD_CHUNK_SIZE) as file:
+			shutil.copyfileobj(response.raw, file, length=DOWNLOAD_CHUNK_SIZE)
 		return
 
 # get a new acess token using the refresh token
@@ -218,43 +288,46 @@ def refresh_access_token(config):
 	url = 'https://' + config['domain'] + '/auth/realms/shanoir-ng/protocol/openid-connect/token'
 	payload = {
 		'grant_type' : 'refresh_token',
-		'refresh_token' : refresh_token,
+		'refresh_token' : config['refresh_token'],
 		'client_id' : 'shanoir-uploader'
 	}
-	headers = {'content-type': 'application/x-www-form-urlencoded'}
+	# the outdated bearer token of the session must not be sent to keycloak
+	headers = {'content-type': 'application/x-www-form-urlencoded', 'Authorization': None}
 	print('refresh keycloak token...')
-	response = requests.post(url, data=payload, headers=headers, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'])
+	response = config['session'].post(url, data=payload, headers=headers, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'])
 	if response.status_code != 200:
 		logging.error(f'response status : {response.status_code}, {responses[response.status_code]}')
 	response_json = response.json()
-	return response_json['access_token']
+	return store_tokens(config, response_json)
 
+# verify and proxies are given for each request since the environment (REQUESTS_CA_BUNDLE, HTTP_PROXY...) takes precedence over the session settings
 def perform_rest_request(config, rtype, url, **kwargs):
-	response = None
-	if rtype == 'get':
-		response = requests.get(url, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'], **kwargs)
-	elif rtype == 'post':
-		response = requests.post(url, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'], **kwargs)
-	else:
-		print('Error: unimplemented request type')
-
-	return response
-
+	return config['session'].request(rtype, url, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'], **kwargs)
+
+
+# get a valid access token, asks for a new one if there is none, if it expired or if it is the given outdated token
+# the token lock ensures that a single thread asks for or refreshes the token while the concurrent downloads wait for it
+def get_access_token(config, outdated_token=None):
+	def is_valid():
+		return config['access_token'] is not None and config['access_token'] != outdated_token and time.monotonic() < config['access_token_expiry']
+	if is_valid():
+		return config['access_token']
+	with config['token_lock']:
+		# another thread might have updated the token while this one was waiting for the lock
+		if not is_valid():
+			if config['access_token'] is None:
+				ask_access_token(config)
+			else:
+				refresh_access_token(config)
+		return config['access_token']
 
 # perform a request on the given url, asks for a new access token if the current one is outdated
-def rest_request(config, rtype, url, raise_for_status=True, **kwargs):
-	global access_token
-	if access_token is None:
-		access_token = ask_access_token(config)
-	headers = { 
-		'Authorization' : 'Bearer ' + access_token,
-		'content-type' : 'application/json'
-	}
+def rest_request(config, rtype, url, raise_for_status=True, headers=None, **kwargs):
+	access_token = get_access_token(config)
 	response = perform_rest_request(config, rtype, url, headers=headers, **kwargs)
-	# if token is outdated, refresh it and try again
+	# if token is nevertheless outdated, refresh it and try again
 	if response.status_code == 401:
-		access_token = refresh_access_token(config)
-		headers['Authorization'] = 'Bearer ' + access_token
+		get_access_token(config, access_token)
 		response = perform_rest_request(config, rtype, url, headers=headers, **kwargs)
 	if raise_for_status:
 		response.raise_for_status()
@@ -276,6 +349,66 @@ def rest_get(config, url, params=None, stream=None):
 def rest_post(config, url, params=None, files=None, stream=None, json=None, data=None):
 	return rest_request(config, 'post', url, params=params, files=files, stream=stream, json=json, data=data)
 
+# check that the response to a "Range: bytes=offset-" request contains the remaining bytes of the file
+def is_expected_partial_content(response, offset):
+	if response.status_code != 206:
+		return False
+	content_range = re.match(r'bytes (\d+)-', response.headers.get('Content-Range', ''))
+	return content_range is not None and int(content_range.group(1)) == offset
+
+# names given to the files downloaded by this process, and the lock held while choosing one, so that two downloads never get the same name
+DOWNLOAD_FILENAME_LOCK = threading.Lock()
+DOWNLOADED_FILENAMES = set()
+
+# get a file name which was not given to another download of this process, by appending a number to the stem of the given one if needed
+# a file left by a previous run is overwritten, as re-downloading a dataset replaces its archive
+def get_available_filename(filename):
+	path = Path(filename)
+	n = 1
+	while str(path) in DOWNLOADED_FILENAMES:
+		path = Path(filename).with_name(f'{Path(filename).stem}_{n}{Path(filename).suffix}')
+		n += 1
+	DOWNLOADED_FILENAMES.add(str(path))
+	return str(path)
+
+# download the file served at the given url in the output folder
+# the file is written to the part_name file and renamed once complete ; an interrupted download (in this run or a previous one) is resumed with a range request
+# part_name must identify the request (dataset ids and format) since the server can give the same file name to different downloads
+def download_file(config, rtype, url, part_name, **kwargs):
+	part_filename = str(config['output_folder'] / part_name)
+	attempt = 0
+	while True:
+		response = None
+		try:
+			offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+			if offset > 0:
+				response = rest_request(config, rtype, url, raise_for_status=False, stream=True, headers={ 'Range': f'bytes={offset}-' }, **kwargs)
+				if response.status_code == 200:
+					# the server ignored the range, restart from the beginning
+					offset = 0
+				elif not is_expected_partial_content(response, offset):
+					response.close()
+					response = None
+			if response is None:
+				offset = 0
+				response = rest_request(config, rtype, url, stream=True, **kwargs)
+			filename = get_filename_from_response(config['output_folder'], response)
+			write_response(response, part_filename, 'ab' if offset > 0 else 'wb', offset)
+			break
+		# without tqdm, the raw urllib3 stream is read and raises the urllib3 exceptions instead of the requests ones
+		except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, ProtocolError, ReadTimeoutError) as e:
+			if response is not None:
+				response.close()
+			if attempt >= DOWNLOAD_RETRIES:
+				raise
+			logging.warning(f'Download of {part_name} interrupted ({e}), resuming...')
+			time.sleep(DOWNLOAD_BACKOFF_FACTOR * 2 ** attempt)
+			attempt += 1
+	with DOWNLOAD_FILENAME_LOCK:
+		filename = get_available_filename(filename)
+		os.replace(part_filename, filename)
+	return filename
+
 # # get every acquisition equipment from shanoir
 # url = 'https://' + config['domain'] + '/shanoir-ng/studies/acquisitionequipments'
 # print(json.dumps(rest_get(url), indent=4, sort_keys=True))
@@ -294,31 +427,33 @@ def rest_post(config, url, params=None, files=None, stream=None, json=None, data
 def download_dataset(config, dataset_id, file_format, silent=False):
 	if not silent:
 		print('Downloading dataset', dataset_id)
-	file_format = 'nii' if file_format == 'nifti' else 'dcm'
-	url = 'https://' + config['domain'] + '/shanoir-ng/datasets/datasets/download/' + str(dataset_id)
-	response = rest_get(config, url, params={ 'format': file_format })
-	download_file(config['output_folder'], response)
-	return
+	file_format = FILE_FORMATS[file_format]
+	url = f"https://{config['domain']}/shanoir-ng/datasets/datasets/download/{dataset_id}"
+	return download_file(config, 'get', url, f'dataset_{dataset_id}_{file_format}.part', params={ 'format': file_format })
 
 def download_datasets(config, dataset_ids, file_format):
-	if len(dataset_ids) > 50:
-		logging.warning('Cannot download more than 50 datasets at once. Please use the --search_text option instead to download the datasets one by one.')
+	if len(dataset_ids) > MAX_DATASETS_PER_DOWNLOAD:
+		logging.warning(f'Cannot download more than {MAX_DATASETS_PER_DOWNLOAD} datasets in a single archive, use download_datasets_in_batches to download them in several archives.')
 		return
 	print('Downloading datasets', dataset_ids)
-	file_format = 'nii' if file_format == 'nifti' else 'dcm'
+	file_format = FILE_FORMATS[file_format]
 	dataset_ids = ','.join([str(dataset_id) for dataset_id in dataset_ids])
-	url = 'https://' + config['domain'] + '/shanoir-ng/datasets/datasets/massiveDownload'
+	url = f"https://{config['domain']}/shanoir-ng/datasets/datasets/massiveDownload"
 	params = dict(datasetIds=dataset_ids, format=file_format)
-	response = rest_post(config, url, params=params, files=params, stream=True)
-	download_file(config['output_folder'], response)
+	part_name = f'datasets_{hashlib.sha1(dataset_ids.encode()).hexdigest()[:16]}_{file_format}.part'
+	return download_file(config, 'post', url, part_name, params=params)
+
+# download the datasets in archives of at most MAX_DATASETS_PER_DOWNLOAD datasets
+def download_datasets_in_batches(config, dataset_ids, file_format):
+	for i in range(0, len(dataset_ids), MAX_DATASETS_PER_DOWNLOAD):
+		download_datasets(config, dataset_ids[i:i+MAX_DATASETS_PER_DOWNLOAD], file_format)
 	return
 
 def download_dataset_by_study(config, study_id, file_format):
 	print('Downloading datasets from study', study_id)
-	file_format = 'nii' if file_format == 'nifti' else 'dcm'
-	url = 'https://' + config['domain'] + '/shanoir-ng/datasets/datasets/massiveDownloadByStudy'
-	response = rest_get(config, url, params={ 'studyId': study_id, 'format': file_format })
-	download_file(config['output_folder'], response)
+	file_format = FILE_FORMATS[file_format]
+	url = f"https://{config['domain']}/shanoir-ng/datasets/datasets/massiveDownloadByStudy"
+	download_file(config, 'get', url, f'study_{study_id}_{file_format}.part', params={ 'studyId': study_id, 'format': file_format })
 	return
 
 def find_dataset_ids_by_subject_id(config, subject_id):
@@ -335,12 +470,12 @@ def find_dataset_ids_by_subject_id_study_id(config, subject_id, study_id):
 
 def download_dataset_by_subject(config, subject_id, file_format):
 	dataset_ids = find_dataset_ids_by_subject_id(config, subject_id)
-	download_datasets(config, dataset_ids, file_format)
+	download_datasets_in_batches(config, dataset_ids, file_format)
 	return
 
 def download_dataset_by_subject_id_study_id(config, subject_id, study_id, file_format):
 	dataset_ids = find_dataset_ids_by_subject_id_study_id(config, subject_id, study_id)
-	download_datasets(config, dataset_ids, file_format)
+	download_datasets_in_batches(config, dataset_ids, file_format)
 	return
 
 def download_datasets_from_ids(args):
@@ -361,9 +496,8 @@ def download_datasets_from_ids(args):
 	try:
 
 		if dataset_ids:
-			with open(dataset_ids) as file:
-				dataset_id_list = [dataset_id.strip() for dataset_id in file]
-				download_datasets(config, dataset_id_list, file_format)
+			dataset_id_list = [line.strip() for line in dataset_ids.read_text().splitlines() if line.strip()]
+			download_datasets_in_batches(config, dataset_id_list, file_format)
 
 		if dataset_id != '':
 			download_dataset(config, dataset_id, file_format, False)
@@ -434,19 +568,95 @@ def solr_search(config, args):
 
 	return response
 	
+# file of the output folder recording the archive of each downloaded search result: { 'datasetid_format': { 'filename': ..., 'size': ... } }
+DOWNLOAD_MANIFEST_FILENAME = 'download_manifest.json'
+
+# the same dataset can be downloaded in each format, so entries are identified by both
+def get_download_manifest_key(dataset_id, file_format):
+	return f'{dataset_id}_{file_format}'
+
+def load_download_manifest(output_folder):
+	manifest_path = Path(output_folder) / DOWNLOAD_MANIFEST_FILENAME
+	if not manifest_path.exists():
+		return {}
+	try:
+		return json.loads(manifest_path.read_text())
+	except (OSError, ValueError) as e:
+		logging.warning(f'Could not read {manifest_path} ({e}), all search results will be checked again.')
+		return {}
+
+# the manifest is written to a temporary file first, so that an interrupted write never leaves a truncated manifest
+def save_download_manifest(output_folder, manifest):
+	manifest_path = Path(output_folder) / DOWNLOAD_MANIFEST_FILENAME
+	temporary_path = manifest_path.with_name(manifest_path.name + '.tmp')
+	temporary_path.write_text(json.dumps(manifest, indent=4))
+	os.replace(temporary_path, manifest_path)
+
+# check that the archive recorded in the manifest for the given dataset is still complete in the output folder
+def is_in_download_manifest(output_folder, manifest, dataset_id, file_format):
+	entry = manifest.get(get_download_manifest_key(dataset_id, file_format))
+	if entry is None:
+		return False
+	filename = Path(output_folder) / entry['filename']
+	return filename.exists() and filename.stat().st_size == entry['size']
+
+# ask the name and size of the dataset archive with a HEAD request, returns the archive filename if it is already complete in the output folder
+# the server builds the whole archive to answer, so the request is only sent when an archive of the output folder might be this one (not the log, manifest or .part files)
+def find_downloaded_dataset(config, dataset_id, file_format):
+	candidates = [path for path in Path(config['output_folder']).glob(f'*{dataset_id}*.zip') if path.is_file()]
+	if len(candidates) == 0:
+		return None
+	url = f"https://{config['domain']}/shanoir-ng/datasets/datasets/download/{dataset_id}"
+	response = rest_request(config, 'head', url, raise_for_status=False, params={ 'format': FILE_FORMATS[file_format] })
+	if response.status_code != 200 or 'content-length' not in response.headers or 'Content-Disposition' not in response.headers:
+		return None
+	filename = get_filename_from_response(config['output_folder'], response)
+	return filename if os.path.exists(filename) and os.path.getsize(filename) == int(response.headers['content-length']) else None
+
+def download_dataset_if_missing(config, dataset_id, file_format):
+	try:
+		filename = find_downloaded_dataset(config, dataset_id, file_format)
+	except requests.RequestException as e:
+		logging.warning(f'Could not check whether dataset {dataset_id} is already downloaded ({e}), downloading it.')
+		filename = None
+	if filename is not None:
+		logging.info(f'Dataset {dataset_id} is already downloaded in {filename}, skipping it.')
+		return filename
+	return download_dataset(config, dataset_id, file_format, True)
+
 def download_search_results(config, args, response):
 
 	if response.status_code == 200:
-		json_content = response.json()['content']
-		for item in json_content:
-			try:
-				download_dataset(config, item['datasetId'], args.format, False)
-			except requests.HTTPError as e:
-				log_response(e)
-			except requests.RequestException as e:
-				logging.error(str(e))
-			except Exception as e:
-				logging.error(str(e))
+		output_folder = config['output_folder']
+		manifest = load_download_manifest(output_folder)
+		all_dataset_ids = [item['datasetId'] for item in response.json()['content']]
+		dataset_ids = [dataset_id for dataset_id in all_dataset_ids if not is_in_download_manifest(output_folder, manifest, dataset_id, args.format)]
+		if len(dataset_ids) < len(all_dataset_ids):
+			logging.info(f'Skipping {len(all_dataset_ids) - len(dataset_ids)} datasets already downloaded in {output_folder} (see {DOWNLOAD_MANIFEST_FILENAME}).')
+		batch_size = args.batch_size
+		with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+			if batch_size == 1:
+				futures = { executor.submit(download_dataset_if_missing, config, dataset_id, args.format): [dataset_id] for dataset_id in dataset_ids }
+			else:
+				batches = [dataset_ids[i:i+batch_size] for i in range(0, len(dataset_ids), batch_size)]
+				futures = { executor.submit(download_datasets, config, batch, args.format): batch for batch in batches }
+			for future in as_completed(futures):
+				try:
+					filename = future.result()
+				except requests.HTTPError as e:
+					logging.error(f'Could not download datasets {futures[future]}')
+					log_response(e)
+					continue
+				except requests.RequestException as e:
+					logging.error(f'Could not download datasets {futures[future]}: {e}')
+					continue
+				except Exception as e:
+					logging.error(f'Could not download datasets {futures[future]}: {e}')
+					continue
+				if filename is not None:
+					for dataset_id in futures[future]:
+						manifest[get_download_manifest_key(dataset_id, args.format)] = { 'filename': Path(filename).name, 'size': os.path.getsize(filename) }
+					save_download_manifest(output_folder, manifest)
 	return
 
 
@@ -464,4 +674,5 @@ if __name__ == '__main__':
 	elif any([getattr(args, arg_name) is not None for arg_name in ['dataset_id', 'dataset_ids', 'study_id', 'subject_id']]):
 		download_datasets_from_ids(args)
 	else:
-		print('You must either provide the search_text argument, or an argument in the list [dataset_id, dataset_ids, study_id, subject_id].')
\ No newline at end of file
+		print('You must either provide the search_text argument, or an argument in the list [dataset_id, dataset_ids, study_id, subject_id].')
+	config['session'].close()
\ No newline at end of file